@@ -1,12 +1,15 @@
 import argparse
 import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import visdom
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import (BatchSampler, DataLoader, RandomSampler,
+                              TensorDataset)
 
 from neuralsea import NeuralSEA
 
@@ -21,6 +24,12 @@ parser.add_argument('--valid_batch_size',
                     type=int,
                     default=50,
                     help='validating batch size (default: 50)')
+parser.add_argument(
+    '--accum_steps',
+    type=int,
+    default=1,
+    help='number of batches to accumulate gradients over per optimizer '
+    'step, the effective batch size is batch_size * accum_steps (default: 1)')
 parser.add_argument('--epochs',
                     type=int,
                     default=100,
@@ -38,11 +47,26 @@ parser.add_argument('--warm_start',
                     default='',
                     help='path to warm start model')
 parser.add_argument('--cuda', action='store_true', help='use cuda?')
+parser.add_argument('--amp',
+                    type=str,
+                    default='off',
+                    choices=['off', 'bf16', 'fp16'],
+                    help='mixed precision, needs --cuda (default: off)')
+parser.add_argument('--compile',
+                    action='store_true',
+                    help='compile the network with torch.compile '
+                    '(ignored with --deterministic)?')
+parser.add_argument('--preload_gpu',
+                    action='store_true',
+                    help='keep the whole datasets on the GPU?')
 parser.add_argument('--visdom', action='store_true', help='use visdom?')
+parser.add_argument('--tensorboard',
+                    action='store_true',
+                    help='use tensorboard?')
 parser.add_argument('--env',
                     type=str,
                     default='NeuralSEA',
-                    help='visdom environmnet')
+                    help='visdom environmnet and tensorboard run name')
 parser.add_argument('--X_train',
                     type=str,
                     default='./data/X_train.npy',
@@ -62,8 +86,9 @@ parser.add_argument('--y_valid',
 parser.add_argument(
     '--threads',
     type=int,
-    default=4,
-    help='number of threads for data loader to use (default: 4)')
+    default=-1,
+    help='number of threads for data loader to use, -1 picks it from the '
+    'CPU count (default: -1)')
 parser.add_argument(
     '--pth_dir',
     type=str,
@@ -73,18 +98,32 @@ parser.add_argument('--seed',
                     type=int,
                     default=42,
                     help='Seed for reproducibility (default: 42)')
+parser.add_argument('--deterministic',
+                    action='store_true',
+                    help='use deterministic cuDNN algorithms and no TF32?')
 ###############################################################################
 
 
-def seed(s):
+def seed(s, deterministic):
     ''' Seed for reproducibility '''
 
     np.random.seed(s)
     torch.manual_seed(s)
 
     if torch.cuda.is_available():
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+        if deterministic:
+            torch.backends.cudnn.deterministic = True
+            torch.backends.cudnn.benchmark = False
+            torch.backends.cuda.matmul.allow_tf32 = False
+            torch.backends.cudnn.allow_tf32 = False
+        else:
+            # Input shapes are fixed, so let cuDNN pick the fastest
+            # algorithms once and allow TF32 on tensor cores
+            torch.backends.cudnn.deterministic = False
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision('high')
 
 
 def setup_visdom(env):
@@ -118,6 +157,42 @@ def setup_visdom(env):
     return vis, loss_win, acc_win
 
 
+def log_visdom(vis, loss_win, acc_win, epoch, train_loss, valid_loss,
+               valid_acc):
+    ''' Log an epoch to Visdom '''
+
+    vis.line(X=np.array([epoch]),
+             Y=np.array([train_loss]),
+             win=loss_win,
+             update='append',
+             name='train')
+
+    vis.line(X=np.array([epoch]),
+             Y=np.array([valid_loss]),
+             win=loss_win,
+             update='append',
+             name='valid')
+
+    vis.line(X=np.array([epoch]),
+             Y=np.array([valid_acc]),
+             win=acc_win,
+             update='append',
+             name='valid')
+
+
+def setup_tensorboard(env):
+    ''' Setup TensorBoard '''
+
+    # Imported here, as tensorboard is an optional extra
+    try:
+        from torch.utils.tensorboard import SummaryWriter
+    except ImportError:
+        parser.error('--tensorboard needs tensorboard, install it with: '
+                     'poetry install -E tensorboard')
+
+    return SummaryWriter(os.path.join('runs', env))
+
+
 def setup_device(use_cuda):
     ''' Setup device '''
 
@@ -137,32 +212,118 @@ def setup_device(use_cuda):
     return device
 
 
-def get_dataset_loader(X_path, y_path, batch_size, threads):
+def setup_amp(amp, device):
+    ''' Setup automatic mixed precision '''
+
+    if amp == 'off':
+        return None, torch.amp.GradScaler('cuda', enabled=False)
+
+    if device.type != 'cuda':
+        raise Exception('Mixed precision needs a GPU, please run with: --cuda')
+
+    if amp == 'bf16' and not torch.cuda.is_bf16_supported():
+        print('BF16 is not supported by this GPU, falling back to FP16')
+        amp = 'fp16'
+
+    amp_dtype = torch.bfloat16 if amp == 'bf16' else torch.float16
+    # BF16 keeps the FP32 exponent range, only FP16 needs loss scaling
+    scaler = torch.amp.GradScaler('cuda', enabled=(amp == 'fp16'))
+
+    print('AMP:', amp_dtype)
+    print('=' * 15)
+
+    return amp_dtype, scaler
+
+
+def get_dataset_loader(X_path, y_path, batch_size, threads, device,
+                       preload_gpu=False):
     ''' Get set loader'''
 
     print('Load set')
     print('=' * 15)
-    dataset = TensorDataset(torch.from_numpy(np.load(X_path)),
-                            torch.from_numpy(np.load(y_path)))
+    # Memory-map the sets, so pages are only read in when batches index
+    # them (this works with shuffling too). Copy-on-write keeps the arrays
+    # writable for torch.from_numpy without copying them.
+    # The sets keep their stored (e.g. uint8 one-hot) dtype, batches are
+    # cast to float only after they have been copied to the device
+    X = torch.from_numpy(np.load(X_path, mmap_mode='c'))
+    y = torch.from_numpy(np.load(y_path, mmap_mode='c'))
+
+    if preload_gpu and device.type == 'cuda':
+        set_size = X.numel() * X.element_size() + y.numel() * y.element_size()
+        free_memory, _ = torch.cuda.mem_get_info(device)
+
+        if set_size > 0.5 * free_memory:
+            print('Set does not fit on the GPU, keeping it in host memory')
+        else:
+            dataset = TensorDataset(X.to(device), y.to(device))
+            # Sample whole batches of indices, so each batch is gathered
+            # on the GPU with a single indexing op instead of being
+            # collated sample by sample
+            sampler = BatchSampler(RandomSampler(dataset),
+                                   batch_size=batch_size,
+                                   drop_last=False)
+
+            return DataLoader(dataset=dataset,
+                              sampler=sampler,
+                              batch_size=None,
+                              num_workers=0)
+
+    if threads < 0:
+        threads = max(min((os.cpu_count() or 0) - 2, 8), 0)
+
+    if threads == 0 and device.type == 'cuda':
+        print('Warning: loading batches in the main process may starve '
+              'the GPU, consider setting --threads')
+
+    # Keep the workers alive across epochs and their queues full
+    kwargs = {}
+    if threads > 0:
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = 4
+
+    dataset = TensorDataset(X, y)
     dataset_loader = DataLoader(dataset=dataset,
                                 batch_size=batch_size,
                                 num_workers=threads,
-                                shuffle=True)
+                                shuffle=True,
+                                pin_memory=(device.type == 'cuda'),
+                                **kwargs)
 
     return dataset_loader
 
 
-def build_net(warm_start, device):
+def build_net(warm_start, device, compile_net=False):
     ''' Build the network '''
 
     print('Building the network')
     if warm_start != '':
         print('Warm start from network at:', warm_start)
         print('=' * 15)
-        net = torch.load(warm_start, map_location=device).type(torch.float)
+        # Checkpoints hold only tensors and plain values, so they can be
+        # loaded with weights_only. The net is built on the CPU and moved
+        # afterwards, so load there too
+        outdated = (f'{warm_start} predates state dict checkpoints, '
+                    'networks pickled as a whole can not be warm started')
+        try:
+            state = torch.load(warm_start, map_location='cpu',
+                               weights_only=True)
+        except pickle.UnpicklingError:
+            raise Exception(outdated)
+        if not isinstance(state, dict) or 'model_state_dict' not in state:
+            raise Exception(outdated)
+
+        net = NeuralSEA()
+        net.load_state_dict(state['model_state_dict'])
+        net = net.to(device, dtype=torch.float)
     else:
         net = NeuralSEA().to(device, dtype=torch.float)
 
+    # Input shapes are fixed, so the graph is compiled once per batch size.
+    # The LSTM breaks the graph, hence no fullgraph=True
+    if compile_net and device.type == 'cuda':
+        net = torch.compile(net)
+
     print('=' * 30)
     print(net)
     print('=' * 30)
@@ -179,75 +340,181 @@ def get_objective():
     return objective
 
 
-def get_optimizer(params, lr, weight_decay):
+def get_optimizer(params, lr, weight_decay, device):
     ''' Get Optimizer '''
 
-    optimizer = optim.AdamW(params, lr=lr, weight_decay=weight_decay)
+    # Batch the per-parameter update ops into a few kernels on the GPU
+    kwargs = {}
+    if device.type == 'cuda':
+        kwargs['fused'] = True
+
+    optimizer = optim.AdamW(params, lr=lr, weight_decay=weight_decay, **kwargs)
     print('Optimizer:', optimizer)
 
     return optimizer
 
 
-def train(net, epoch, train_set_loader, device, objective, optimizer):
+class CUDAPrefetcher:
+    ''' CUDA Prefetcher
+
+    Wraps a set loader and copies the next batch to the GPU on a side
+    stream, while the current batch is being processed on the main one
+
+    '''
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        # Batches of a set already on the GPU are gathered on the main
+        # stream, so the side stream has to wait for them to be written,
+        # and their memory must not be reused while it still reads them
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        for tensor in batch:
+            if tensor.is_cuda:
+                tensor.record_stream(self.stream)
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = (
+                batch[0].to(self.device, non_blocking=True).float(),
+                batch[1].to(self.device, non_blocking=True).float(),
+            )
+
+    def __next__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+
+        # The batch was allocated on the side stream, but is used on the
+        # main one - keep its memory from being reused too early
+        for tensor in batch:
+            tensor.record_stream(current_stream)
+
+        self.preload()
+
+        return batch
+
+
+def prefetch(loader, device):
+    ''' Overlap host-to-device copies with compute, if on a GPU '''
+
+    if device.type == 'cuda':
+        return CUDAPrefetcher(loader, device)
+
+    return loader
+
+
+def train(net, epoch, train_set_loader, device, objective, optimizer,
+          amp_dtype, scaler, accum_steps):
     ''' Train step '''
 
     net.train()
-    epoch_loss = 0.0
+    # Accumulate on the device, to sync with the host once per epoch
+    epoch_loss = torch.zeros((), device=device)
 
-    for i, data in enumerate(train_set_loader, 1):
-        input, target = (data[0].to(device, dtype=torch.float),
-                         data[1].to(device, dtype=torch.float))
+    optimizer.zero_grad(set_to_none=True)
+    for i, data in enumerate(prefetch(train_set_loader, device), 1):
+        input, target = (data[0].to(device, non_blocking=True).float(),
+                         data[1].to(device, non_blocking=True).float())
 
-        optimizer.zero_grad()
+        with torch.autocast(device.type,
+                            dtype=amp_dtype,
+                            enabled=amp_dtype is not None):
+            output = net(input)
+            loss = objective(output, target)
+        epoch_loss += loss.detach()
 
-        output = net(input)
-        loss = objective(output, target)
-        epoch_loss += loss.item()
+        # Average the gradients over the batches of each update - the last
+        # group of the epoch may hold fewer than `accum_steps` of them
+        group_start = (i - 1) // accum_steps * accum_steps
+        group_size = min(accum_steps, len(train_set_loader) - group_start)
+        scaler.scale(loss / group_size).backward()
 
-        loss.backward()
-        optimizer.step()
+        # A disabled scaler falls through to plain backward() and step()
+        if i % accum_steps == 0 or i == len(train_set_loader):
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
         if i % 10000 == 0:
             print(f'===> Epoch[{epoch}]({i}/{len(train_set_loader)}): \
                     Loss: {round(loss.item(), 7)}')
 
-    train_loss = round(epoch_loss / len(train_set_loader), 7)
+    train_loss = round((epoch_loss / len(train_set_loader)).item(), 7)
     print(f'=====> Epoch {epoch} Completed: \
             Avg. Loss: {train_loss}')
 
     return train_loss
 
 
-def validate(net, valid_set_loader, device, objective):
+def validate(net, valid_set_loader, device, objective, amp_dtype):
     ''' Validate step '''
 
     net.eval()
-    avg_loss = 0.0
-    avg_acc = 0.0
+    # Accumulate on the device, to sync with the host once per epoch
+    avg_loss = torch.zeros((), device=device)
+    avg_acc = torch.zeros((), device=device)
 
     with torch.no_grad():
-        for data in valid_set_loader:
-            input, target = (data[0].to(device, dtype=torch.float),
-                             data[1].to(device, dtype=torch.float))
+        for data in prefetch(valid_set_loader, device):
+            input, target = (data[0].to(device, non_blocking=True).float(),
+                             data[1].to(device, non_blocking=True).float())
 
-            output = net(input)
+            with torch.autocast(device.type,
+                                dtype=amp_dtype,
+                                enabled=amp_dtype is not None):
+                output = net(input)
 
-            loss = objective(output, target)
-            avg_loss += loss.item()
+                loss = objective(output, target)
+            avg_loss += loss
 
-            pred = torch.sigmoid(output).round()
-            avg_acc += (torch.sum(target.view(-1) == pred.view(-1)).float() /
-                        target.numel()).item()
+            # sigmoid(x) >= 0.5 iff x >= 0, the logits can be thresholded
+            pred = output >= 0
+            avg_acc += (target.bool() == pred).float().mean()
 
-    valid_loss = round(avg_loss / len(valid_set_loader), 7)
-    valid_acc = round(avg_acc / len(valid_set_loader), 7)
+    valid_loss = round((avg_loss / len(valid_set_loader)).item(), 7)
+    valid_acc = round((avg_acc / len(valid_set_loader)).item(), 7)
     print(f'=======> Avg. Valid Loss: {valid_loss}\
             Avg. Valid Acc: {valid_acc}')
 
     return valid_loss, valid_acc
 
 
-def checkpoint(net, pth_dir, epoch, valid_acc):
+def to_cpu(obj):
+    ''' Copy every tensor in a (nested) state dict to the CPU '''
+
+    if torch.is_tensor(obj):
+        # copy=True, so CPU tensors are not shared with the training loop
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+
+    return obj
+
+
+def checkpoint(net, optimizer, scaler, pth_dir, epoch, valid_loss, valid_acc,
+               executor):
     ''' Checkpoint step '''
 
     if not os.path.exists(pth_dir):
@@ -255,57 +522,104 @@ def checkpoint(net, pth_dir, epoch, valid_acc):
 
     path = os.path.join(pth_dir,
                         f'neuralsea-epoch-{epoch}-acc-{valid_acc}.pth')
-    torch.save(net, path)
-    print(f'Checkpoint saved to {path}')
+    # Unwrap compiled networks, to keep the keys loadable
+    net = getattr(net, '_orig_mod', net)
+
+    # Snapshot the states on the CPU, then write them to disk in the
+    # background while the next epoch is already running. Only the model
+    # state is restored by --warm_start, the optimizer and scaler states
+    # are kept for resuming runs outside of this script
+    state = {
+        'model_state_dict': to_cpu(net.state_dict()),
+        'optimizer_state_dict': to_cpu(optimizer.state_dict()),
+        'epoch': epoch,
+        'valid_loss': valid_loss,
+    }
+    if scaler.is_enabled():
+        state['scaler_state_dict'] = scaler.state_dict()
+
+    print(f'Saving checkpoint to {path}')
+
+    return executor.submit(torch.save, state, path)
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error('--accum_steps must be at least 1')
     print(args, end='\n\n')
 
-    seed(args.seed)
+    seed(args.seed, args.deterministic)
 
     if args.visdom:
         vis, loss_win, acc_win = setup_visdom(args.env)
+        # Send the plots from a background thread, so the HTTP requests
+        # to the visdom server do not hold up the next epoch
+        vis_executor = ThreadPoolExecutor(max_workers=1)
+        plotting = None
+
+    if args.tensorboard:
+        writer = setup_tensorboard(args.env)
 
     device = setup_device(args.cuda)
+    amp_dtype, scaler = setup_amp(args.amp, device)
 
     train_set_loader = get_dataset_loader(args.X_train, args.y_train,
-                                          args.batch_size, args.threads)
+                                          args.batch_size, args.threads,
+                                          device, args.preload_gpu)
     valid_set_loader = get_dataset_loader(args.X_valid, args.y_valid,
-                                          args.valid_batch_size, args.threads)
+                                          args.valid_batch_size, args.threads,
+                                          device, args.preload_gpu)
 
-    net = build_net(args.warm_start, device)
+    if args.compile and args.deterministic:
+        print('Not compiling the network, as --deterministic is set')
+    net = build_net(args.warm_start, device,
+                    args.compile and not args.deterministic)
     objective = get_objective()
-    optimizer = get_optimizer(net.parameters(), args.lr, args.weight_decay)
+    optimizer = get_optimizer(net.parameters(), args.lr, args.weight_decay,
+                              device)
+
+    # Checkpoints are written one at a time, off the training loop
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    saving = None
 
     # RUN
     print()
     print('Training...')
     for epoch in range(1, args.epochs + 1):
         train_loss = train(net, epoch, train_set_loader, device, objective,
-                           optimizer)
+                           optimizer, amp_dtype, scaler, args.accum_steps)
         valid_loss, valid_acc = validate(net, valid_set_loader, device,
-                                         objective)
+                                         objective, amp_dtype)
 
-        checkpoint(net, args.pth_dir, epoch, valid_acc)
+        # Wait for the previous checkpoint, surfacing any error it raised
+        if saving is not None:
+            saving.result()
+        saving = checkpoint(net, optimizer, scaler, args.pth_dir, epoch,
+                            valid_loss, valid_acc, checkpoint_executor)
         print()
 
         if args.visdom:
-            vis.line(X=np.array([epoch]),
-                     Y=np.array([train_loss]),
-                     win=loss_win,
-                     update='append',
-                     name='train')
-
-            vis.line(X=np.array([epoch]),
-                     Y=np.array([valid_loss]),
-                     win=loss_win,
-                     update='append',
-                     name='valid')
-
-            vis.line(X=np.array([epoch]),
-                     Y=np.array([valid_acc]),
-                     win=acc_win,
-                     update='append',
-                     name='valid')
+            # Wait for the previous plots, surfacing any error they raised
+            if plotting is not None:
+                plotting.result()
+            plotting = vis_executor.submit(log_visdom, vis, loss_win,
+                                           acc_win, epoch, train_loss,
+                                           valid_loss, valid_acc)
+
+        if args.tensorboard:
+            writer.add_scalar('loss/train', train_loss, epoch)
+            writer.add_scalar('loss/valid', valid_loss, epoch)
+            writer.add_scalar('accuracy/valid', valid_acc, epoch)
+
+    if saving is not None:
+        saving.result()
+    checkpoint_executor.shutdown(wait=True)
+
+    if args.visdom:
+        if plotting is not None:
+            plotting.result()
+        vis_executor.shutdown(wait=True)
+
+    if args.tensorboard:
+        writer.close()